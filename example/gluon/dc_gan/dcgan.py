@@ -21,52 +21,46 @@ from datetime import datetime
 import argparse
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib as mpl
+# all convolution shapes are fixed, so let cuDNN autotune pick the fastest algorithm
+# even if it needs more than the default workspace; must be set before mxnet is imported
+os.environ.setdefault('MXNET_CUDNN_AUTOTUNE_DEFAULT', '2')
 import mxnet as mx
 from mxnet import gluon
 from mxnet.gluon import nn
 from mxnet import autograd
+from mxnet import amp
 from inception_score import get_inception_score
 
 mpl.use('Agg')
 
 
-def fill_buf(buf, i, img, shape):
-    """Reposition the images generated by the generator so that it can be saved as picture matrix.
-    :param buf: the images metric
-    :param i: index of each image
-    :param img: images generated by generator once
-    :param shape: each image`s shape
-    :return: Adjust images for output
-    """
-    n = buf.shape[0]//shape[1]
-    m = buf.shape[1]//shape[0]
-
-    sx = (i%m)*shape[0]
-    sy = (i//m)*shape[1]
-    buf[sy:sy+shape[1], sx:sx+shape[0], :] = img
-
-
-def visual(title, X, name):
+def visual(X, name):
     """Image visualization and preservation
-    :param title: title
     :param X: images to visualized
     :param name: saved picture`s name
     :return:
     """
     assert len(X.shape) == 4
     X = X.transpose((0, 2, 3, 1))
-    X = np.clip((X - np.min(X))*(255.0/(np.max(X) - np.min(X))), 0, 255).astype(np.uint8)
-    n = np.ceil(np.sqrt(X.shape[0]))
-    buff = np.zeros((int(n*X.shape[1]), int(n*X.shape[2]), int(X.shape[3])), dtype=np.uint8)
-    for i, img in enumerate(X):
-        fill_buf(buff, i, img, X.shape[1:3])
+    # one pass for each of min and max, then scale in place; the result is already in [0, 255]
+    low, high = X.min(), X.max()
+    X = X - low
+    X *= 255.0 / (high - low)
+    X = X.astype(np.uint8)
+    num, height, width, channel = X.shape
+    n = int(np.ceil(np.sqrt(num)))
+    # pad to a full n x n grid, then tile the images in one reshape/transpose
+    padded = np.zeros((n * n, height, width, channel), dtype=np.uint8)
+    padded[:num] = X
+    buff = padded.reshape((n, n, height, width, channel)).transpose((0, 2, 1, 3, 4))
+    buff = buff.reshape((n * height, n * width, channel))
     buff = buff[:, :, ::-1]
-    plt.imshow(buff)
-    plt.title(title)
-    plt.savefig(name)
+    # write the pixels directly instead of rendering a figure with axes and title
+    plt.imsave(name, buff)
 
 
 parser = argparse.ArgumentParser()
@@ -81,9 +75,17 @@ parser.add_argument('--ndf', type=int, default=64, help='the channel of each des
 parser.add_argument('--nepoch', type=int, default=25, help='number of epochs to train for, default is 25.')
 parser.add_argument('--niter', type=int, default=10, help='save generated images and inception_score per niter iters, '
                                                           'default is 100.')
+parser.add_argument('--log-interval', type=int, default=50, help='log losses and accuracy per log-interval iters, '
+                                                                 'default is 50.')
 parser.add_argument('--lr', type=float, default=0.0002, help='learning rate, default=0.0002')
 parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for adam. default=0.5')
 parser.add_argument('--cuda', action='store_true', help='enables cuda')
+parser.add_argument('--num-gpus', type=int, default=1, help='number of GPUs to train on when cuda is enabled, '
+                                                            'default is 1.')
+parser.add_argument('--grad-accum', type=int, default=1, help='accumulate gradients over grad-accum batches '
+                                                                'before each update, default is 1.')
+parser.add_argument('--fp16', action='store_true', help='train in float16 mixed precision with AMP, '
+                                                           'requires cuda.')
 parser.add_argument('--netG', default='', help="path to netG (to continue training)")
 parser.add_argument('--netD', default='', help="path to netD (to continue training)")
 parser.add_argument('--outf', default='./results', help='folder to output images and model checkpoints')
@@ -101,11 +103,16 @@ ngf = int(opt.ngf)
 ndf = int(opt.ndf)
 niter = opt.niter
 nc = 3
+assert opt.num_gpus >= 1, 'num-gpus must be at least 1'
 if opt.cuda:
-    ctx = mx.gpu(0)
+    ctx = [mx.gpu(i) for i in range(opt.num_gpus)]
 else:
-    ctx = mx.cpu()
+    ctx = [mx.cpu()]
 batch_size = opt.batch_size
+assert batch_size % len(ctx) == 0, 'batch size must be divisible by the number of devices'
+assert opt.cuda or not opt.fp16, 'float16 training requires cuda'
+assert opt.grad_accum >= 1, 'grad-accum must be at least 1'
+assert opt.log_interval >= 1, 'log-interval must be at least 1'
 check_point = bool(opt.check_point)
 outf = opt.outf
 dataset = opt.dataset
@@ -162,10 +169,28 @@ def get_dataset(dataset_name):
     return train_data, val_data
 
 
+def prefetch_to_context(data_iter, ctx):
+    """Issue the copy of the next batch to ctx before handing out the current one
+    :param data_iter: iterable of (data, label) batches
+    :param ctx: list of contexts to split data across
+    :return: generator of (data, label) with data already split and loaded on ctx
+    """
+    pending = None
+    for data, label in data_iter:
+        # the copies are pushed to the engine asynchronously, so they overlap
+        # with the compute of the batch that is still being trained on
+        batch = (gluon.utils.split_and_load(data, ctx), label)
+        if pending is not None:
+            yield pending
+        pending = batch
+    if pending is not None:
+        yield pending
+
+
 def get_netG():
     """Get net G"""
     # build the generator
-    netG = nn.Sequential()
+    netG = nn.HybridSequential()
     with netG.name_scope():
         # input is Z, going into a convolution
         netG.add(nn.Conv2DTranspose(ngf * 8, 4, 1, 0, use_bias=False))
@@ -194,7 +219,7 @@ def get_netG():
 def get_netD():
     """Get the netD"""
     # build the discriminator
-    netD = nn.Sequential()
+    netD = nn.HybridSequential()
     with netD.name_scope():
         # input is (nc) x 64 x 64
         netD.add(nn.Conv2D(ndf, 4, 2, 1, use_bias=False))
@@ -214,6 +239,8 @@ def get_netD():
         # state size. (ndf*8) x 4 x 4
         netD.add(nn.Conv2D(2, 4, 1, 0, use_bias=False))
         # state size. 2 x 1 x 1
+        netD.add(nn.Flatten())
+        # state size. 2
 
     return netD
 
@@ -226,14 +253,48 @@ def get_configurations(netG, netD):
     # initialize the generator and the discriminator
     netG.initialize(mx.init.Normal(0.02), ctx=ctx)
     netD.initialize(mx.init.Normal(0.02), ctx=ctx)
+    if opt.grad_accum > 1:
+        netG.setattr('grad_req', 'add')
+        netD.setattr('grad_req', 'add')
 
     # trainer for the generator and the discriminator
-    trainerG = gluon.Trainer(netG.collect_params(), 'adam', {'learning_rate': opt.lr, 'beta1': opt.beta1})
-    trainerD = gluon.Trainer(netD.collect_params(), 'adam', {'learning_rate': opt.lr, 'beta1': opt.beta1})
+    # (AMP dynamic loss scaling only supports updating the parameters outside of the kvstore)
+    update_on_kvstore = False if opt.fp16 else None
+    trainerG = gluon.Trainer(netG.collect_params(), 'adam', {'learning_rate': opt.lr, 'beta1': opt.beta1},
+                             kvstore='device', update_on_kvstore=update_on_kvstore)
+    trainerD = gluon.Trainer(netD.collect_params(), 'adam', {'learning_rate': opt.lr, 'beta1': opt.beta1},
+                             kvstore='device', update_on_kvstore=update_on_kvstore)
+    if opt.fp16:
+        amp.init_trainer(trainerG)
+        amp.init_trainer(trainerD)
 
     return loss, trainerG, trainerD
 
 
+def amp_scale(loss, trainer):
+    """Scale the loss by the AMP loss scale of trainer when training in float16
+    :param loss: list of losses, must be called inside autograd.record()
+    :param trainer: trainer that updates the parameters the loss is backpropagated to
+    :return: the losses to call backward on
+    """
+    if not opt.fp16:
+        return loss
+    with amp.scale_loss(loss, trainer) as scaled_loss:
+        return scaled_loss
+
+
+def update_accuracy(correct, labels, outputs):
+    """Accumulate the number of correct discriminator predictions on each device
+    :param correct: list of per-device counters, updated in place
+    :param labels: list of per-device labels
+    :param outputs: list of per-device discriminator outputs
+    :return: number of predictions counted
+    """
+    for num_correct, label, output in zip(correct, labels, outputs):
+        num_correct += (output.argmax(axis=1) == label).sum()
+    return sum(label.shape[0] for label in labels)
+
+
 def ins_save(inception_score):
     # draw the inception_score curve
     length = len(inception_score)
@@ -249,17 +310,36 @@ def ins_save(inception_score):
 def main():
     """Entry point to dcgan"""
     print("|------- new changes!!!!!!!!!")
+    # AMP has to be initialized before the networks are created
+    if opt.fp16:
+        amp.init()
     # to get the dataset and net configuration
     train_data, val_data = get_dataset(dataset)
     netG = get_netG()
     netD = get_netD()
+    # the training data drops the last incomplete batch, so every call sees the same
+    # shapes and the cached graphs can use static memory and shapes
+    netG.hybridize(static_alloc=True, static_shape=True)
+    # static memory only pays off if each backward pass through netD requests the same
+    # gradients, which is not the case when accumulating gradients (see the training loop)
+    if opt.grad_accum == 1:
+        netD.hybridize(static_alloc=True, static_shape=True)
+    else:
+        netD.hybridize()
     loss, trainerG, trainerD = get_configurations(netG, netD)
 
-    # set labels
-    real_label = mx.nd.ones((opt.batch_size,), ctx=ctx)
-    fake_label = mx.nd.zeros((opt.batch_size,), ctx=ctx)
+    # each device works on an equal slice of the batch
+    shard_size = opt.batch_size // len(ctx)
 
-    metric = mx.gluon.metric.Accuracy()
+    # set labels
+    real_label = [mx.nd.ones((shard_size,), ctx=c) for c in ctx]
+    fake_label = [mx.nd.zeros((shard_size,), ctx=c) for c in ctx]
+    # noise buffers, refilled in place every iteration
+    noise = [mx.nd.empty((shard_size, nz, 1, 1), ctx=c) for c in ctx]
+
+    # binary training accuracy, counted on the devices and only read back when reported
+    correct = [mx.nd.zeros((1,), ctx=c) for c in ctx]
+    total = 0
     print('Training... ')
     stamp = datetime.now().strftime('%Y_%m_%d-%H_%M')
 
@@ -270,68 +350,111 @@ def main():
     loss_g = []
     inception_score = []
 
+    # images are normalized and written to disk off the training thread
+    vis_pool = ThreadPoolExecutor(max_workers=1)
+    vis_futures = []
+
     for epoch in range(opt.nepoch):
         tic = time.time()
         btic = time.time()
-        for data, _ in train_data:
+        for data, _ in prefetch_to_context(train_data, ctx):
             ############################
             # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
             ###########################
             # train with real_t
-            data = data.as_in_context(ctx)
-            noise = mx.nd.random.normal(0, 1, shape=(opt.batch_size, nz, 1, 1), ctx=ctx)
+            for z in noise:
+                mx.nd.random.normal(0, 1, out=z)
 
             with autograd.record():
-                output = netD(data)
-                # reshape output from (opt.batch_size, 2, 1, 1) to (opt.batch_size, 2)
-                output = output.reshape((opt.batch_size, 2))
-                errD_real = loss(output, real_label)
+                output = [netD(x) for x in data]
+                errD_real = [loss(o, l) for o, l in zip(output, real_label)]
 
-            metric.update([real_label, ], [output, ])
+            total += update_accuracy(correct, real_label, output)
 
             with autograd.record():
-                fake = netG(noise)
-                output = netD(fake.detach())
-                output = output.reshape((opt.batch_size, 2))
-                errD_fake = loss(output, fake_label)
-                errD = errD_real + errD_fake
-
-            errD.backward()
-            metric.update([fake_label,], [output,])
-
-            trainerD.step(opt.batch_size)
-
-            ############################
-            # (2) Update G network: maximize log(D(G(z)))
-            ###########################
+                fake = [netG(z) for z in noise]
+
+            # netD runs only once on the generated batch: its output feeds both the D loss and
+            # the G loss. The netD input is cut from netG's graph so that errD stops at it,
+            # and the gradient of errG w.r.t. it is pushed through netG by hand.
+            fake_d = [f.detach() for f in fake]
+            for f in fake_d:
+                f.attach_grad()
             with autograd.record():
-                output = netD(fake)
-                output = output.reshape((-1, 2))
-                errG = loss(output, real_label)
-
-            errG.backward()
-
-            trainerG.step(opt.batch_size)
-
-            name, acc = metric.get()
-            logging.info('discriminator loss = %f, generator loss = %f, binary training acc = %f at iter %d epoch %d'
-                         , mx.nd.mean(errD).asscalar(), mx.nd.mean(errG).asscalar(), acc, iter, epoch)
+                output = [netD(f) for f in fake_d]
+                errD_fake = [loss(o, l) for o, l in zip(output, fake_label)]
+                errD = [r + f for r, f in zip(errD_real, errD_fake)]
+                ############################
+                # (2) Update G network: maximize log(D(G(z)))
+                ###########################
+                errG = [loss(o, l) for o, l in zip(output, real_label)]
+                scaled_errD = amp_scale(errD, trainerD)
+                scaled_errG = amp_scale(errG, trainerG)
+
+            if opt.grad_accum == 1:
+                # backward errG first, its netD parameter gradients are overwritten by errD
+                # below. Both passes request the same gradients, so the static backward plan of
+                # the hybridized netD is reused.
+                autograd.backward(scaled_errG, retain_graph=True)
+                autograd.backward(fake, [f.grad for f in fake_d])
+            else:
+                # with grad_req='add' errG must not touch the netD parameter gradients, so only
+                # the gradient w.r.t. the netD input is taken. The two passes through netD then
+                # request different gradients, and each one rebuilds netD's backward plan; this
+                # is why netD is not statically allocated in this mode.
+                fake_grad = autograd.grad(scaled_errG, fake_d, retain_graph=True)
+                autograd.backward(fake, fake_grad)
+            autograd.backward(scaled_errD)
+            total += update_accuracy(correct, fake_label, output)
+
+            # the trainers allreduce the gradients of all devices through the kvstore. With
+            # --grad-accum the gradients of the intermediate batches only add up locally on
+            # each device, so there is one allreduce per update.
+            if (iter + 1) % opt.grad_accum == 0:
+                trainerD.step(opt.batch_size * opt.grad_accum)
+                trainerG.step(opt.batch_size * opt.grad_accum)
+                if opt.grad_accum > 1:
+                    netD.zero_grad()
+                    netG.zero_grad()
+
+            # reading the losses back blocks on the device, so only do it when actually logging
+            if iter % opt.log_interval == 0 and logging.getLogger().isEnabledFor(logging.INFO):
+                acc = sum(c.asscalar() for c in correct) / total
+                logging.info('discriminator loss = %f, generator loss = %f, binary training acc = %f at iter %d epoch %d'
+                             , np.mean([e.mean().asscalar() for e in errD]),
+                             np.mean([e.mean().asscalar() for e in errG]), acc, iter, epoch)
             if iter % niter == 0:
-                visual('gout', fake.asnumpy(), name=os.path.join(outf, 'fake_img_iter_%d.png' % iter))
-                visual('data', data.asnumpy(), name=os.path.join(outf, 'real_img_iter_%d.png' % iter))
+                # netG outputs float16 under --fp16, but cv2.resize in the inception score
+                # has no float16 kernel
+                fake_images = mx.nd.concat(*[f.as_in_context(mx.cpu()) for f in fake], dim=0)
+                fake_images = fake_images.astype('float32', copy=False)
+                real_images = mx.nd.concat(*[x.as_in_context(mx.cpu()) for x in data], dim=0)
+                # surface any error raised while writing the previous images
+                for future in vis_futures:
+                    future.result()
+                # asnumpy stays on this thread, NDArrays must not be handed to the worker
+                vis_futures = [
+                    vis_pool.submit(visual, fake_images.asnumpy(),
+                                    os.path.join(outf, 'fake_img_iter_%d.png' % iter)),
+                    vis_pool.submit(visual, real_images.asnumpy(),
+                                    os.path.join(outf, 'real_img_iter_%d.png' % iter))]
                 # record the metric data
                 loss_d.append(errD)
                 loss_g.append(errG)
                 if opt.inception_score:
-                    score, _ = get_inception_score(fake)
+                    score, _ = get_inception_score(fake_images)
                     inception_score.append(score)
 
             iter = iter + 1
             btic = time.time()
 
-        name, acc = metric.get()
-        metric.reset()
-        logging.info('\nbinary training acc at epoch %d: %s=%f', epoch, name, acc)
+        mx.nd.waitall()
+        # an epoch yields no batch if the dataset is smaller than the batch size
+        acc = sum(c.asscalar() for c in correct) / total if total else float('nan')
+        for c in correct:
+            c[:] = 0
+        total = 0
+        logging.info('\nbinary training acc at epoch %d: accuracy=%f', epoch, acc)
         logging.info('time: %f', time.time() - tic)
 
         # save check_point
@@ -339,6 +462,16 @@ def main():
             netG.save_parameters(os.path.join(outf, 'generator_epoch_%d.params' %epoch))
             netD.save_parameters(os.path.join(outf, 'discriminator_epoch_%d.params' % epoch))
 
+    # apply the gradients of the batches accumulated since the last update
+    leftover = iter % opt.grad_accum
+    if leftover:
+        trainerD.step(opt.batch_size * leftover)
+        trainerG.step(opt.batch_size * leftover)
+
+    for future in vis_futures:
+        future.result()
+    vis_pool.shutdown()
+
     # save parameter
     netG.save_parameters(os.path.join(outf, 'generator.params'))
     netD.save_parameters(os.path.join(outf, 'discriminator.params'))